@@ -0,0 +1,160 @@
+"""
+Local simulation of a year of synthetic traffic against VisitorsSam, with and without TTL expiry.
+
+No AWS involved: the table is modelled as a dict and each request is charged the capacity units
+DynamoDB would bill for the ops in ``FetchUpdate`` (conditional PutItem + COUNT Scan without TTL,
+GetItem + occasional UpdateItem/TransactWriteItems + GetItem of the aggregate + COUNT Scan with TTL).
+Synthetic visitors hop between dynamic IPs and get their browser auto-updated, which is exactly what inflates
+the number of distinct (IP, UA) pairs per human.
+
+Usage:
+    $ python3 -m benchmarks.ttl_simulation
+"""
+import math
+import random
+
+from fetch_visitors.app import FetchUpdate
+
+DAY_SEC = 24 * 60 * 60
+DAYS = 365
+SEED = 42
+
+RETURNING_HUMANS = 300      # people who keep coming back, each with their own visit frequency
+ONE_OFF_PER_DAY = 15        # people who visit once and never again
+IP_CHANGE_EVERY_DAYS = 14   # mean lifetime of a dynamic IP lease
+UA_CHANGE_EVERY_DAYS = 28   # mean time between browser auto-updates
+TTL_REAP_DELAY_SEC = DAY_SEC  # DynamoDB deletes expired items in the background, typically within a day or two
+
+SCAN_RCU_BYTES = 4096       # eventually consistent scans are billed 0.5 RCU per 4KB read
+ITEM_OVERHEAD_BYTES = len("IP") + len("UA")
+EXPIRES_BYTES = len("expires") + 6  # numbers take ~1 byte per 2 significant digits, plus 1
+SINCE_BYTES = len("since") + 6
+TRANSACT_WCU_PER_ITEM = 2   # transactional writes are billed double
+
+
+class Human:
+    def __init__(self, rnd, visits_per_day):
+        self.rnd = rnd
+        self.visits_per_day = visits_per_day
+        self.ip = self.new_ip()
+        self.ua = self.new_ua()
+
+    def new_ip(self):
+        return "%d.%d.%d.%d" % tuple(self.rnd.randint(1, 254) for _ in range(4))
+
+    def new_ua(self):
+        version = self.rnd.randint(90, 200)
+        return "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML,like Gecko) " \
+               "Chrome/%d.0.0.0 Safari/537.36" % version
+
+    def drift(self):
+        """Called once a day: maybe the ISP hands out a new IP, maybe the browser updates itself"""
+        if self.rnd.random() < 1 / IP_CHANGE_EVERY_DAYS:
+            self.ip = self.new_ip()
+        if self.rnd.random() < 1 / UA_CHANGE_EVERY_DAYS:
+            self.ua = self.new_ua()
+
+
+class SimTable:
+    """
+    Models the VisitorsSam table and the capacity units consumed by FetchUpdate's requests against it
+    """
+
+    def __init__(self, ttl: bool):
+        self.ttl = ttl
+        self.items = {}  # (ip, ua) -> expires, or None if not stamped
+        self.bytes = 0
+        self.lifetime = 0
+        self.rcu = 0.0
+        self.wcu = 0.0
+
+    @staticmethod
+    def item_bytes(key, expires) -> int:
+        size = ITEM_OVERHEAD_BYTES + len(key[0]) + len(key[1])
+        return size + (EXPIRES_BYTES + SINCE_BYTES if expires is not None else 0)
+
+    def putitem(self, key, now):
+        """
+        Without TTL, mirrors the original conditional PutItem: a failed conditional write is still billed 1 WCU.
+        With TTL, mirrors FetchUpdate.db_putitem(): a GetItem, then a write only if the visitor is new or stale
+        """
+        if not self.ttl:
+            self.wcu += 1
+            if key not in self.items:
+                self.items[key] = None
+                self.bytes += self.item_bytes(key, None)
+                self.lifetime += 1
+            return
+
+        self.rcu += 0.5
+        expires = self.items.get(key)
+        if expires is None or expires < now:  # new, or expired but not reaped yet
+            if expires is None:
+                self.bytes += self.item_bytes(key, now)
+            self.items[key] = now + FetchUpdate.VISITOR_TTL_SEC
+            self.lifetime += 1
+            self.wcu += 2 * TRANSACT_WCU_PER_ITEM  # visitor item + aggregate, see FetchUpdate.db_addvisitor()
+        elif expires < now + FetchUpdate.VISITOR_TTL_SEC - FetchUpdate.TTL_REFRESH_SEC:
+            self.items[key] = now + FetchUpdate.VISITOR_TTL_SEC
+            self.wcu += 1
+
+    def count(self):
+        """Mirrors FetchUpdate.db_gettotal() + db_scan(): a scan is billed for every item examined"""
+        self.rcu += math.ceil(self.bytes / SCAN_RCU_BYTES) * 0.5
+        if self.ttl:
+            self.rcu += 0.5  # GetItem of the aggregate
+
+    def reap(self, now):
+        if self.ttl:
+            self.items = {k: e for k, e in self.items.items() if e + TTL_REAP_DELAY_SEC >= now}
+            self.bytes = sum(self.item_bytes(k, e) for k, e in self.items.items())
+
+
+def simulate(ttl: bool) -> list:
+    """
+    :param ttl: Whether VisitorsSam items expire
+    :return: One (day, table size, requests, RCU, WCU, lifetime total) tuple per 30 days simulated
+    :rtype: list
+    """
+    rnd = random.Random(SEED)  # same traffic for both runs
+    humans = [Human(rnd, rnd.paretovariate(1.5) / 20) for _ in range(RETURNING_HUMANS)]
+    table = SimTable(ttl)
+    report = []
+    requests = rcu = wcu = 0
+
+    for day in range(DAYS):
+        visits = []
+        for h in humans:
+            h.drift()
+            for _ in range(int(h.visits_per_day) + (rnd.random() < h.visits_per_day % 1)):
+                visits.append((rnd.randrange(DAY_SEC), h.ip, h.ua))
+        for _ in range(ONE_OFF_PER_DAY):
+            h = Human(rnd, 0)
+            visits.append((rnd.randrange(DAY_SEC), h.ip, h.ua))
+
+        for sec, ip, ua in sorted(visits):
+            now = day * DAY_SEC + sec
+            table.putitem((ip, ua), now)
+            table.count()
+        table.reap((day + 1) * DAY_SEC)
+
+        requests += len(visits)
+        if (day + 1) % 30 == 0 or day + 1 == DAYS:
+            report.append((day + 1, len(table.items), requests, table.rcu - rcu, table.wcu - wcu, table.lifetime))
+            requests, rcu, wcu = 0, table.rcu, table.wcu
+
+    return report
+
+
+def main():
+    for ttl in (False, True):
+        print("=== %s ===" % ("With TTL expiry (%d days, refreshed at most every %d hours)" % (
+            FetchUpdate.VISITOR_TTL_SEC // DAY_SEC, FetchUpdate.TTL_REFRESH_SEC // 3600) if ttl else "Without expiry"))
+        print("%5s %10s %10s %12s %12s %10s" % ("day", "items", "requests", "RCU/request", "WCU/request", "lifetime"))
+        for day, items, requests, rcu, wcu, lifetime in simulate(ttl):
+            print("%5d %10d %10d %12.2f %12.2f %10d" % (day, items, requests, rcu / requests, wcu / requests, lifetime))
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
+import os
+import hmac
 import json
+import time
 import boto3
 import logging
 
@@ -19,7 +22,8 @@ def lambda_handler(event, context):
     Returns:
         dict: A dict with keys
             result (str): "added|found|error"
-            visitors (int): N
+            visitors (int): N, the lifetime total
+            recent (int): M, the unique visitors seen within the retention window
             error (str): Stringified exception message if thrown.
 
             This will be passed to ``json.dumps``
@@ -28,38 +32,64 @@ def lambda_handler(event, context):
 
     result = ""
     count = -1
+    recent = -1
     errorMsg = None
     fu = FetchUpdate(event)
     origin = ""
     try:
         ip, ua = fu.extract_ip_ua()
         origin = fu.extract_origin()
+        fu.extract_test_marker()
         result = fu.db_putitem(ip, ua)
-        count = fu.db_scan()
+        count = fu.db_gettotal()
+        recent = fu.db_scan()
     except Exception as e:
         errorMsg = str(e)
     finally:
-        return fu.send_resp(result, count, errorMsg, origin)
+        return fu.send_resp(result, count, errorMsg, origin, recent)
 
 
 class FetchUpdate:
     """
     Runner class to perform the ops we need and save internal state.
-    Consists of 4 self-explanatory Methods executing one step each, as per the Single Responsibility Principle (SRP)
+    Consists of 7 self-explanatory Methods executing one step each, as per the Single Responsibility Principle (SRP)
 
     Methods
     -------
         extract_ip_ua():
+        extract_test_marker():
         db_putitem():
+        db_addvisitor():
+        db_gettotal():
         db_scan():
         send_resp():
     """
 
+    TBL_NAME = "VisitorsSam"
+    STATS_TBL_NAME = "VisitorStatsSam"
+    STAT_LIFETIME = "lifetime"
+
+    # Test traffic (eg. the integration tests) is marked with this header and kept in its own table and aggregate,
+    # so that counting real visitors never reads (and pays for) test items.
+    # The header must carry the secret token set in this env var, so that visitors can't opt out of being counted
+    TEST_HEADER = "x-test-visitor"
+    TEST_TOKEN_ENV = "TEST_VISITOR_TOKEN"
+    TEST_TBL_NAME = "VisitorsSamTest"
+    TEST_STAT_LIFETIME = "lifetime-test"
+
+    # Visitor items are stamped with an `expires` epoch (the table's TTL attribute) so the table only holds
+    # a rolling window of visitors. Repeat visits push the expiry forward, but at most once per refresh period.
+    # Items added (and counted in the lifetime total) by this function also carry a `since` epoch
+    VISITOR_TTL_SEC = 30 * 24 * 60 * 60
+    TTL_REFRESH_SEC = 24 * 60 * 60
+
     ERR_NO_IP = "Couldn't extract source IP! Skipping insertion"
     ERR_NO_UA = "Couldn't extract UA! Skipping insertion"
     ERR_NO_ORIGIN = "Couldn't extract Origin!"
     ERR_PUT_ITEM = "Unexpected error while putting item: %s"
+    ERR_ADD_VISITOR = "Unexpected error while adding visitor and bumping lifetime total: %s"
     ERR_SCAN = "Unexpected error while scanning DB: %s"
+    ERR_TOTAL = "Unexpected error while fetching lifetime total: %s"
 
     DEFAULT_ACAO = "https://resume.laripping.com"
     ORIGIN_WHITELIST = [
@@ -73,6 +103,8 @@ class FetchUpdate:
         self.event = event
         self.client = boto3.client('dynamodb', region_name='eu-west-2')
         self.dynamodb = boto3.resource('dynamodb', region_name='eu-west-2')  # needed for the exception
+        self.tbl_name = FetchUpdate.TBL_NAME
+        self.stat_lifetime = FetchUpdate.STAT_LIFETIME
 
     def extract_ip_ua(self) -> tuple:
         """
@@ -138,30 +170,66 @@ class FetchUpdate:
         log.info("Successfully extracted Origin %s", origin)
         return origin
 
+    def extract_test_marker(self) -> bool:
+        """
+        Step 1.75: Check whether the request is marked as test traffic, and if so
+        point the following DB steps to the test table and aggregate instead of the real ones
+
+        :return: True if the request carries the test header (any case) set to the expected token
+        :rtype: bool
+        """
+        token = os.environ.get(FetchUpdate.TEST_TOKEN_ENV, "")
+        headers = self.event.get("headers") or {}
+        values = [v for h, v in headers.items() if h.lower() == FetchUpdate.TEST_HEADER]
+        if not token or not values:
+            return False
+        if not hmac.compare_digest(str(values[0]).encode(), token.encode()):
+            log.info("Test header with an unexpected value ignored, counting as a real visitor")
+            return False
+
+        log.info("Test traffic, using table %s", FetchUpdate.TEST_TBL_NAME)
+        self.tbl_name = FetchUpdate.TEST_TBL_NAME
+        self.stat_lifetime = FetchUpdate.TEST_STAT_LIFETIME
+        return True
+
     def db_putitem(self, ip, ua) -> str:
         """
-        Step 2: Try to add visitor info to DB if not exists
+        Step 2: Try to add visitor info to DB if not exists, or refresh its expiry if stale.
+        New visitors (incl. those whose item expired but TTL hasn't reaped yet) are added by ``db_addvisitor()``
 
         :return: The result of the database insertion (added|found) OR throws
         :rtype: str
-        :raises: Exception when PutItem operation fails
+        :raises: Exception when GetItem/UpdateItem operation fails
         """
 
+        now = int(time.time())
+        key = {"IP": {"S": ip}, "UA": {"S": ua}}
         try:
-            putitem_resp = self.client.put_item(
-                TableName='VisitorsSam',  # TODO extract TBL_NAME constant
-                Item={
-                    "UA": {"S": ua},
-                    "IP": {"S": ip}
-                },
-                ConditionExpression='attribute_not_exists(IP) and attribute_not_exists(UA)'
-            )
-            log.debug("put_item response: %s", json.dumps(putitem_resp, indent=2))
-            log.info("Visitor details added to the database")
-            result = "added"
+            getitem_resp = self.client.get_item(TableName=self.tbl_name, Key=key)
+            log.debug("get_item response: %s", json.dumps(getitem_resp, indent=2))
+            old = getitem_resp.get("Item")
+            expires = int(old["expires"]["N"]) if old and "expires" in old else None
+
+            if not old or (expires is not None and expires < now):
+                result = None
+            elif expires is not None and expires >= now + FetchUpdate.VISITOR_TTL_SEC - FetchUpdate.TTL_REFRESH_SEC:
+                log.info("Visitor details already in the database. Not added")
+                result = "found"
+            else:
+                # Expiry last pushed more than TTL_REFRESH_SEC ago (or never): push it, keeping the other attributes
+                update_resp = self.client.update_item(
+                    TableName=self.tbl_name,
+                    Key=key,
+                    UpdateExpression="SET expires = :exp",
+                    ConditionExpression="attribute_exists(IP)",
+                    ExpressionAttributeValues={":exp": {"N": str(now + FetchUpdate.VISITOR_TTL_SEC)}}
+                )
+                log.debug("update_item response: %s", json.dumps(update_resp, indent=2))
+                log.info("Visitor details already in the database. Expiry refreshed")
+                result = "found"
         except botocore.exceptions.ClientError as ce:
             if ce.response['Error']['Code'] == 'ConditionalCheckFailedException':
-                log.info("Visitor details already in the database. Not added")
+                log.info("Visitor details expired meanwhile. Not refreshed")
                 result = "found"
             else:
                 log.error(FetchUpdate.ERR_PUT_ITEM, str(ce))
@@ -170,22 +238,112 @@ class FetchUpdate:
             log.error(FetchUpdate.ERR_PUT_ITEM, str(e))  # here we only log FetchUpdate.ERR_PUT_ITEM,
             raise e  # ...and not specify it, as we're interested in the orig msg
 
+        if result is None:
+            result = self.db_addvisitor(key, now)
         return result
 
+    def db_addvisitor(self, key, now) -> str:
+        """
+        Step 2.5: Add the visitor item and increment the lifetime total in a single transaction,
+        so the item can't exist without having been counted in the aggregate (which TTL expiry never touches)
+
+        :param key: The IP/UA key of the visitor item
+        :param now: The epoch the expiry of the item is computed from
+
+        :return: "added", or "found" if another request added the visitor meanwhile
+        :rtype: str
+        :raises: Exception when TransactWriteItems operation fails
+        """
+        try:
+            transact_resp = self.client.transact_write_items(
+                TransactItems=[
+                    {"Put": {
+                        "TableName": self.tbl_name,
+                        "Item": {
+                            **key,
+                            "expires": {"N": str(now + FetchUpdate.VISITOR_TTL_SEC)},
+                            "since": {"N": str(now)}
+                        },
+                        "ConditionExpression": "attribute_not_exists(IP) or expires < :now",
+                        "ExpressionAttributeValues": {":now": {"N": str(now)}}
+                    }},
+                    {"Update": {
+                        "TableName": FetchUpdate.STATS_TBL_NAME,
+                        "Key": {"Stat": {"S": self.stat_lifetime}},
+                        "UpdateExpression": "ADD Visitors :one",
+                        "ExpressionAttributeValues": {":one": {"N": "1"}}
+                    }}
+                ]
+            )
+            log.debug("transact_write_items response: %s", json.dumps(transact_resp, indent=2))
+            log.info("Visitor details added to the database")
+            result = "added"
+        except botocore.exceptions.ClientError as ce:
+            reasons = ce.response.get("CancellationReasons", [])
+            if ce.response['Error']['Code'] == 'TransactionCanceledException' \
+                    and reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+                log.info("Visitor details added meanwhile. Not added")
+                result = "found"
+            else:
+                log.error(FetchUpdate.ERR_ADD_VISITOR, str(ce))
+                raise ce
+        except Exception as e:
+            log.error(FetchUpdate.ERR_ADD_VISITOR, str(e))
+            raise e
+
+        return result
+
+    def db_gettotal(self) -> int:
+        """
+        Step 3: Fetch the lifetime total of visitors from the aggregate item.
+        Until migrations/ttl_backfill.py has seeded it with the visitors from before it existed,
+        the real visitors are counted the way they used to be, so the count served never drops
+
+        :return: The number of visitors ever added, or 0 if the test aggregate has not been created yet
+        :rtype: int
+        """
+        try:
+            getitem_resp = self.client.get_item(
+                TableName=FetchUpdate.STATS_TBL_NAME,
+                Key={"Stat": {"S": self.stat_lifetime}}
+            )
+            log.debug("get_item response: %s", json.dumps(getitem_resp, indent=2))
+            item = getitem_resp.get("Item", {})
+            if self.stat_lifetime == FetchUpdate.STAT_LIFETIME and "Seeded" not in item:
+                log.info("Lifetime total not seeded yet, counting all visitors instead")
+                scan_resp = self.client.scan(
+                    TableName=self.tbl_name,
+                    Select='COUNT',
+                    FilterExpression="test <> :istest",
+                    ExpressionAttributeValues={
+                        ":istest": {"BOOL": True}
+                    }
+                )
+                log.debug("scan response: %s", json.dumps(scan_resp, indent=2))
+                return scan_resp["Count"]
+            if "Visitors" not in item:
+                return 0
+            return int(item["Visitors"]["N"])
+        except Exception as e:
+            log.error(FetchUpdate.ERR_TOTAL, str(e))
+            raise e
+
     def db_scan(self) -> int:
         """
-        Step 3: Query DB for the number of total visitors seen
+        Step 3.5: Query DB for the number of unique visitors seen within the retention window.
+        Items past their expiry that TTL hasn't deleted yet are left out.
+        Test items live in their own table, so there's no need to filter them out here (and pay for reading them)
 
-        :return: The number of items found in the DB
+        :return: The number of live items found in the DB
         :rtype: int
         """
         try:
             scan_resp = self.client.scan(
-                TableName='VisitorsSam',
+                TableName=self.tbl_name,
                 Select='COUNT',
-                FilterExpression="test <> :istest",
+                FilterExpression="attribute_not_exists(expires) or expires >= :now",
                 ExpressionAttributeValues={
-                    ":istest": {"BOOL": True}
+                    ":now": {"N": str(int(time.time()))}
                 }
             )
             log.debug("scan response: %s", json.dumps(scan_resp, indent=2))
@@ -195,14 +353,15 @@ class FetchUpdate:
             log.error(FetchUpdate.ERR_SCAN, str(e))
             raise e
 
-    def send_resp(self, result: str, count: int, errorMsg: str, origin: str) -> dict:
+    def send_resp(self, result: str, count: int, errorMsg: str, origin: str, recent: int = -1) -> dict:
         """
         Step 4: Create the HTTP response object incl. any errors thrown in the process
 
         :param result: The result of the DB operation ("added"|"found"|""-default)
-        :param count: The number of items found previously in the DB or -1 - default
+        :param count: The lifetime total of visitors fetched previously or -1 - default
         :param errorMsg: Error thrown previously or None - default
         :param origin: Request origin to process response ACAO header OR ""
+        :param recent: The number of visitors within the retention window or -1 - default
 
         :return: The HTTP response object, including the JSON body, that is immediately returned by the lambda handler.
                     THE JSON MUST BE PASSED THROUGH  ``json.dumps`` FIRST!!
@@ -222,6 +381,9 @@ class FetchUpdate:
         else:
             code = 500
 
+        if recent != -1:
+            jbody.update({"recent": recent})
+
         headers = { "Content-Type": "application/json"}
         # If there's an Origin header, IFF it's an allowed one,  mirror it back into the ACAO header
         # https://stackoverflow.com/questions/1653308/access-control-allow-origin-multiple-origin-domains
@@ -0,0 +1,48 @@
+"""
+One-off migration moving test items out of VisitorsSam into VisitorsSamTest.
+
+Test items used to live next to the real ones, flagged with `test = true`, and every count had to filter them out
+while still paying to read them. Now test traffic goes to its own table, so the leftovers are moved over
+(without the flag, which is now meaningless) and stamped with an expiry if they had none.
+
+Re-running it is harmless: once moved, items are no longer found in VisitorsSam.
+
+Usage (needs creds allowed to Scan/DeleteItem VisitorsSam and PutItem VisitorsSamTest):
+    $ python3 -m migrations.isolate_test_items
+"""
+import time
+import boto3
+
+from fetch_visitors.app import FetchUpdate
+
+
+def migrate(client, now=None) -> int:
+    """
+    :param client: A boto3 dynamodb client
+    :param now: Epoch to compute the expiry of unstamped items from, defaults to the current time
+
+    :return: The number of items moved
+    :rtype: int
+    """
+    now = int(time.time()) if now is None else now
+    moved = 0
+
+    paginator = client.get_paginator("scan")
+    for page in paginator.paginate(
+            TableName=FetchUpdate.TBL_NAME,
+            FilterExpression="test = :istest",
+            ExpressionAttributeValues={":istest": {"BOOL": True}}):
+        for item in page["Items"]:
+            moved_item = {k: v for k, v in item.items() if k != "test"}
+            moved_item.setdefault("expires", {"N": str(now + FetchUpdate.VISITOR_TTL_SEC)})
+            # copy first then delete, so an interruption can at worst leave a duplicate, never lose an item
+            client.put_item(TableName=FetchUpdate.TEST_TBL_NAME, Item=moved_item)
+            client.delete_item(TableName=FetchUpdate.TBL_NAME, Key={"IP": item["IP"], "UA": item["UA"]})
+            moved += 1
+
+    return moved
+
+
+if __name__ == "__main__":
+    moved = migrate(boto3.client("dynamodb", region_name="eu-west-2"))
+    print(f"Moved {moved} test items from {FetchUpdate.TBL_NAME} to {FetchUpdate.TEST_TBL_NAME}")
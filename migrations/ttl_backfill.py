@@ -0,0 +1,86 @@
+"""
+One-off migration for the TTL expiry of VisitorsSam items.
+
+Items written before TTL was enabled carry no `expires` attribute, so they would never be deleted.
+This script stamps each of them with a fresh expiry (as if they were seen just now)
+and adds the number of real visitors they stand for to the lifetime total aggregate, so the count served doesn't reset.
+
+Items added by the deployed function carry a `since` epoch and were already counted when added,
+so only the real visitors without one are added to the aggregate.
+
+Re-running it is harmless: stamped items are skipped and the aggregate is only seeded once (marked `Seeded`).
+
+Usage (needs creds allowed to Scan/UpdateItem both tables):
+    $ python3 -m migrations.ttl_backfill
+"""
+import time
+import boto3
+import logging
+import botocore
+
+from fetch_visitors.app import FetchUpdate
+
+log = logging.getLogger("migrations-logger")
+log.setLevel(logging.INFO)
+
+
+def backfill(client, now=None) -> tuple:
+    """
+    :param client: A boto3 dynamodb client
+    :param now: Epoch to compute the expiry from, defaults to the current time
+
+    :return: (stamped, seeded) the number of items stamped, and the number added to the lifetime total,
+             or None if it had already been seeded
+    :rtype: tuple
+    """
+    now = int(time.time()) if now is None else now
+    expires = str(now + FetchUpdate.VISITOR_TTL_SEC)
+    stamped = 0
+    uncounted = 0
+
+    paginator = client.get_paginator("scan")
+    for page in paginator.paginate(TableName=FetchUpdate.TBL_NAME,
+                                   ProjectionExpression="IP, UA, expires, since, test"):
+        for item in page["Items"]:
+            if not item.get("test", {}).get("BOOL", False) and "since" not in item:
+                uncounted += 1
+            if "expires" in item:
+                continue
+            try:
+                client.update_item(
+                    TableName=FetchUpdate.TBL_NAME,
+                    Key={"IP": item["IP"], "UA": item["UA"]},
+                    UpdateExpression="SET expires = :exp",
+                    ConditionExpression="attribute_not_exists(expires)",  # don't shorten one refreshed meanwhile
+                    ExpressionAttributeValues={":exp": {"N": expires}}
+                )
+                stamped += 1
+            except botocore.exceptions.ClientError as ce:
+                if ce.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise ce
+
+    try:
+        # ADD rather than overwrite: the function may have created the aggregate and counted new visitors already
+        client.update_item(
+            TableName=FetchUpdate.STATS_TBL_NAME,
+            Key={"Stat": {"S": FetchUpdate.STAT_LIFETIME}},
+            UpdateExpression="ADD Visitors :n SET Seeded = :t",
+            ConditionExpression="attribute_not_exists(Seeded)",
+            ExpressionAttributeValues={":n": {"N": str(uncounted)}, ":t": {"N": str(now)}}
+        )
+        log.info("Lifetime total seeded with %d visitors added before it existed", uncounted)
+        seeded = uncounted
+    except botocore.exceptions.ClientError as ce:
+        if ce.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise ce
+        log.warning("Lifetime total already seeded, skipping (would have added %d)", uncounted)
+        seeded = None
+
+    return stamped, seeded
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    stamped, seeded = backfill(boto3.client("dynamodb", region_name="eu-west-2"))
+    print(f"Stamped {stamped} items with an expiry, lifetime total "
+          + (f"seeded with {seeded}" if seeded is not None else "left as is (already seeded)"))
@@ -1,4 +1,5 @@
 import json
+import time
 import boto3
 import botocore
 import pytest
@@ -14,6 +15,13 @@ def event_no_ua():
     return json.loads( open('events/event-no-ua.json').read() )
 
 
+@pytest.fixture
+def test_token(monkeypatch):
+    """Sets the token the test header must carry, as the TestVisitorToken stack parameter would"""
+    monkeypatch.setenv(FetchUpdate.TEST_TOKEN_ENV, "s3cr3t")
+    return "s3cr3t"
+
+
 # For future use
 sample_db = [
     ("10.0.0.1", "Mozilla/1.0 (Pam's Laptop)"),  # home connection, primary device
@@ -33,85 +41,221 @@ class TestExtractIPUA:
         assert FetchUpdate.ERR_NO_UA in str(e.value)
 
 
-class TestDbPutItem:
-    def put_item_mock_that_returns(self, **kwargs):
-        resp_mock = MagicMock(
-            spec=dict)  # spec is needed to mock the json.dumps(put_item_resp) that takes place right after the op
-        resp_mock.return_value = ""
-        return resp_mock
+class TestExtractTestMarker:
+    @pytest.mark.parametrize("header", ["X-Test-Visitor", "x-test-visitor"])
+    def test_marked_uses_test_table(self, header, test_token):
+        fu = FetchUpdate({"headers": {"User-Agent": "dummyUA", header: test_token}})
+
+        is_test = fu.extract_test_marker()
+
+        assert is_test
+        assert fu.tbl_name == FetchUpdate.TEST_TBL_NAME
+        assert fu.stat_lifetime == FetchUpdate.TEST_STAT_LIFETIME
+
+    def test_unmarked_uses_real_table(self, event_no_ua):
+        fu = FetchUpdate(event_no_ua)
+
+        is_test = fu.extract_test_marker()
+
+        assert not is_test
+        assert fu.tbl_name == FetchUpdate.TBL_NAME
+        assert fu.stat_lifetime == FetchUpdate.STAT_LIFETIME
+
+    @pytest.mark.parametrize("value", ["false", "true", "", "s3cr3", "s3cr3t "])
+    def test_wrong_value_uses_real_table(self, value, test_token):
+        """
+        Anyone can send the header, only the expected token can keep a visit out of the real count
+        """
+        fu = FetchUpdate({"headers": {"User-Agent": "dummyUA", "X-Test-Visitor": value}})
 
-    def put_item_mock_that_throws_ccfe(self, **kwargs):
-        error_response = {"Error": {"Code": "ConditionalCheckFailedException"}}
-        ccfe = botocore.exceptions.ClientError(error_response, "dummyop")
-        raise ccfe
+        is_test = fu.extract_test_marker()
 
-    def put_item_mock_that_throws_other_clienterror(self, **kwargs):
+        assert not is_test
+        assert fu.tbl_name == FetchUpdate.TBL_NAME
+        assert fu.stat_lifetime == FetchUpdate.STAT_LIFETIME
+
+    def test_no_token_configured_uses_real_table(self, monkeypatch):
+        monkeypatch.delenv(FetchUpdate.TEST_TOKEN_ENV, raising=False)
+        fu = FetchUpdate({"headers": {"User-Agent": "dummyUA", "X-Test-Visitor": ""}})
+
+        is_test = fu.extract_test_marker()
+
+        assert not is_test
+        assert fu.tbl_name == FetchUpdate.TBL_NAME
+
+
+class TestDbPutItem:
+    def get_item_mock_that_returns_none(self, **kwargs):
+        return {}  # no "Item" -> there is no item with that key
+
+    def get_item_mock_that_returns_old(self, expires=None):
+        def get_item(**kwargs):
+            item = {"IP": {"S": "dummyIP"}, "UA": {"S": "dummyUA"}}
+            if expires is not None:
+                item["expires"] = {"N": str(expires)}
+            return {"Item": item}
+        return get_item
+
+    def transact_mock_that_throws_cancelled(self, **kwargs):
+        error_response = {"Error": {"Code": "TransactionCanceledException"},
+                          "CancellationReasons": [{"Code": "ConditionalCheckFailed"}, {"Code": "None"}]}
+        raise botocore.exceptions.ClientError(error_response, "dummyop")
+
+    def mock_that_throws_other_clienterror(self, **kwargs):
         error_response = {"Error": {"Code": "StillAClientError"}}
         ce = botocore.exceptions.ClientError(error_response, "dummyop")
         raise ce
 
-    def put_item_mock_that_throws_other(self, **kwargs):
+    def mock_that_throws_other(self, **kwargs):
         raise Exception  # just a generic exception, not a ClientError that could signify existence
 
     def test_notexists_in_db(self):
+        fu = FetchUpdate(None)
+        fu.client = Mock()
+        fu.client.get_item.side_effect = self.get_item_mock_that_returns_none
+        fu.client.transact_write_items.return_value = {}
+
+        result = fu.db_putitem("dummyIP","dummyUA")
+
+        fu.client.transact_write_items.assert_called_once()
+        assert result == "added"
+
+    def test_notexists_stamps_expiry_and_bumps_total(self):
         """
-        :return:
+        The item and the bump of the lifetime total are written in the same transaction
+        """
+        # Arrange
+        fu = FetchUpdate(None)
+        fu.client = Mock()
+        fu.client.get_item.side_effect = self.get_item_mock_that_returns_none
+        fu.client.transact_write_items.return_value = {}
+        before = int(time.time())
+
+        # Act
+        fu.db_putitem("dummyIP","dummyUA")
+
+        # Assert
+        put, update = fu.client.transact_write_items.call_args.kwargs["TransactItems"]
+        expires = int(put["Put"]["Item"]["expires"]["N"])
+        assert before + FetchUpdate.VISITOR_TTL_SEC <= expires <= int(time.time()) + FetchUpdate.VISITOR_TTL_SEC
+        assert "since" in put["Put"]["Item"]
+        assert update["Update"]["TableName"] == FetchUpdate.STATS_TBL_NAME
+        assert update["Update"]["UpdateExpression"] == "ADD Visitors :one"
+        fu.client.update_item.assert_not_called()
+
+    def test_fresh_expiry_not_written(self):
+        """
+        Visitor seen less than TTL_REFRESH_SEC ago: nothing to write
+        """
+        fu = FetchUpdate(None)
+        fu.client = Mock()
+        fu.client.get_item.side_effect = self.get_item_mock_that_returns_old(int(time.time()) + FetchUpdate.VISITOR_TTL_SEC)
+
+        result = fu.db_putitem("dummyIP","dummyUA")
+
+        assert result == "found"
+        fu.client.update_item.assert_not_called()
+        fu.client.transact_write_items.assert_not_called()
+
+    @pytest.mark.parametrize("expires", [int(time.time()) + 3600, None])
+    def test_stale_expiry_refreshed(self, expires):
+        """
+        Visitor seen before, more than TTL_REFRESH_SEC ago (or before expiry was introduced): the expiry is pushed
+        but it's still the same visitor, so the total must not move
         """
         fu = FetchUpdate(None)
         fu.client = Mock()
-        fu.client.put_item.side_effect = self.put_item_mock_that_returns
+        fu.client.get_item.side_effect = self.get_item_mock_that_returns_old(expires)
+        fu.client.update_item.return_value = {}
+
+        result = fu.db_putitem("dummyIP","dummyUA")
+
+        assert result == "found"
+        fu.client.update_item.assert_called_once()
+        assert fu.client.update_item.call_args.kwargs["UpdateExpression"] == "SET expires = :exp"
+        fu.client.transact_write_items.assert_not_called()
+
+    def test_expired_not_reaped_readded(self):
+        """
+        Visitor whose item expired but TTL hasn't deleted yet: counts as a new visitor in the window
+        """
+        fu = FetchUpdate(None)
+        fu.client = Mock()
+        fu.client.get_item.side_effect = self.get_item_mock_that_returns_old(int(time.time()) - 3600)
+        fu.client.transact_write_items.return_value = {}
 
         result = fu.db_putitem("dummyIP","dummyUA")
 
-        assert fu.client.put_item.called_once()
         assert result == "added"
+        fu.client.transact_write_items.assert_called_once()
+
+    def test_marked_writes_to_test_table(self, test_token):
+        # Arrange
+        fu = FetchUpdate({"headers": {"X-Test-Visitor": test_token}})
+        fu.extract_test_marker()
+        fu.client = Mock()
+        fu.client.get_item.side_effect = self.get_item_mock_that_returns_none
+        fu.client.transact_write_items.return_value = {}
+
+        # Act
+        fu.db_putitem("dummyIP","dummyUA")
 
+        # Assert
+        assert fu.client.get_item.call_args.kwargs["TableName"] == FetchUpdate.TEST_TBL_NAME
+        put, update = fu.client.transact_write_items.call_args.kwargs["TransactItems"]
+        assert put["Put"]["TableName"] == FetchUpdate.TEST_TBL_NAME
+        assert update["Update"]["Key"] == {"Stat": {"S": FetchUpdate.TEST_STAT_LIFETIME}}
 
     def test_exists_in_db(self):
+        """
+        Another request added the visitor between our read and our transaction
+        """
         fu = FetchUpdate(None)
         fu.client = Mock()
-        fu.client.put_item.side_effect = self.put_item_mock_that_throws_ccfe
+        fu.client.get_item.side_effect = self.get_item_mock_that_returns_none
+        fu.client.transact_write_items.side_effect = self.transact_mock_that_throws_cancelled
 
         result = fu.db_putitem("dummyIP","dummyUA")
 
-        assert fu.client.put_item.called_once()
+        fu.client.transact_write_items.assert_called_once()
         assert result == "found"
 
     def test_db_clienterror_fail(self):
-        """
-        Assessing path app.py:128-129
-        :param ip:
-        :param ua:
-        :param exp_result:
-        :return:
-        """
         fu = FetchUpdate(None)
         fu.client = Mock()
-        fu.client.put_item.side_effect = self.put_item_mock_that_throws_other_clienterror
+        fu.client.get_item.side_effect = self.mock_that_throws_other_clienterror
 
         with pytest.raises(Exception) as e:
             result = fu.db_putitem("dummyIP","dummyUA")
 
-        assert fu.client.put_item.called_once()
+        fu.client.get_item.assert_called_once()
+        fu.client.transact_write_items.assert_not_called()
 
 
     def test_db_other_fail(self):
-        """
-        Assessing path app.py:131-132
-        :param ip:
-        :param ua:
-        :param exp_result:
-        :param sample_db:
-        :return:
-        """
         fu = FetchUpdate(None)
         fu.client = Mock()
-        fu.client.put_item.side_effect = self.put_item_mock_that_throws_other
+        fu.client.get_item.side_effect = self.mock_that_throws_other
 
         with pytest.raises(Exception) as e:
             result = fu.db_putitem("dummyIP","dummyUA")
 
-        assert fu.client.put_item.called_once()
+        fu.client.get_item.assert_called_once()
+
+    def test_add_fail_logged_as_such(self, caplog):
+        """
+        A failed transaction writes neither the item nor the bump, and is reported as an add failure, not a put one
+        """
+        fu = FetchUpdate(None)
+        fu.client = Mock()
+        fu.client.get_item.side_effect = self.get_item_mock_that_returns_none
+        fu.client.transact_write_items.side_effect = self.mock_that_throws_other_clienterror
+
+        with pytest.raises(botocore.exceptions.ClientError):
+            fu.db_putitem("dummyIP","dummyUA")
+
+        assert "Unexpected error while adding visitor" in caplog.text
+        assert "Unexpected error while putting item" not in caplog.text
 
 
 
@@ -140,6 +284,32 @@ class TestDbScan:
         assert fu.client.scan.called_once()
         assert count == 9
 
+    def test_scan_never_examines_test_items(self):
+        """
+        Real visitors are counted from their own table, with no filter on the (now gone) `test` flag
+        """
+        fu = FetchUpdate({"headers": {}})
+        fu.extract_test_marker()
+        fu.client = Mock()
+        fu.client.scan.return_value = {"Count": 9}
+
+        fu.db_scan()
+
+        kwargs = fu.client.scan.call_args.kwargs
+        assert kwargs["TableName"] == FetchUpdate.TBL_NAME
+        assert "test" not in kwargs["FilterExpression"]
+        assert ":istest" not in kwargs["ExpressionAttributeValues"]
+
+    def test_marked_scans_test_table(self, test_token):
+        fu = FetchUpdate({"headers": {"X-Test-Visitor": test_token}})
+        fu.extract_test_marker()
+        fu.client = Mock()
+        fu.client.scan.return_value = {"Count": 9}
+
+        fu.db_scan()
+
+        assert fu.client.scan.call_args.kwargs["TableName"] == FetchUpdate.TEST_TBL_NAME
+
     def test_scan_fail(self):
         fu = FetchUpdate(None)
         fu.client = Mock()
@@ -172,6 +342,61 @@ class TestDbScan:
         assert fu.client.scan.called_once()
 
 
+class TestDbGetTotal:
+
+    def test_total_returned(self):
+        fu = FetchUpdate(None)
+        fu.client = Mock()
+        fu.client.get_item.return_value = {"Item": {"Stat": {"S": "lifetime"}, "Visitors": {"N": "42"},
+                                                    "Seeded": {"N": "1"}}}
+
+        total = fu.db_gettotal()
+
+        fu.client.get_item.assert_called_once()
+        fu.client.scan.assert_not_called()
+        assert total == 42
+
+    @pytest.mark.parametrize("aggregate", [{}, {"Item": {"Stat": {"S": "lifetime"}, "Visitors": {"N": "3"}}}])
+    def test_not_seeded_yet_counts_visitors(self, aggregate):
+        """
+        Between deploy and the backfill, the aggregate is missing or only holds the visitors added since:
+        keep serving the count of all real visitors rather than a reset one
+        """
+        # Arrange
+        fu = FetchUpdate(None)
+        fu.client = Mock()
+        fu.client.get_item.return_value = aggregate
+        fu.client.scan.return_value = {"Count": 40}
+
+        # Act
+        total = fu.db_gettotal()
+
+        # Assert
+        assert total == 40
+        kwargs = fu.client.scan.call_args.kwargs
+        assert kwargs["TableName"] == FetchUpdate.TBL_NAME
+        assert kwargs["FilterExpression"] == "test <> :istest"
+
+    def test_no_test_aggregate_yet(self):
+        fu = FetchUpdate(None)
+        fu.stat_lifetime = FetchUpdate.TEST_STAT_LIFETIME
+        fu.client = Mock()
+        fu.client.get_item.return_value = {}
+
+        total = fu.db_gettotal()
+
+        assert total == 0
+        fu.client.scan.assert_not_called()
+
+    def test_get_fail(self):
+        fu = FetchUpdate(None)
+        fu.client = Mock()
+        fu.client.get_item.side_effect = Exception
+
+        with pytest.raises(Exception) as e:
+            fu.db_gettotal()
+
+
 
 ERR_NO_COUNT = "Something broke, no count :("
 ERR_W_COUNT = "Something broke but we got the count!"
@@ -220,4 +445,10 @@ class TestSendResp:
         fu = FetchUpdate(None)
         returnedObj = fu.send_resp(result,count,errorMsg,"https://resume.laripping.com")
 
-        assert returnedObj == expectedObj
\ No newline at end of file
+        assert returnedObj == expectedObj
+
+    def test_resp_includes_recent(self):
+        fu = FetchUpdate(None)
+        returnedObj = fu.send_resp(RESULT_OK, OK_COUNT, None, "https://resume.laripping.com", 3)
+
+        assert json.loads(returnedObj["body"]) == {"result": RESULT_OK, "visitors": OK_COUNT, "recent": 3}
\ No newline at end of file
@@ -0,0 +1,202 @@
+import botocore
+import pytest
+from unittest.mock import Mock
+from fetch_visitors.app import FetchUpdate
+from migrations.isolate_test_items import migrate
+from migrations.ttl_backfill import backfill
+
+
+def paginator_over(*pages):
+    paginator = Mock()
+    paginator.paginate.return_value = [{"Items": list(items)} for items in pages]
+    return paginator
+
+
+class FakeDynamoDB:
+    """
+    Just enough of a dynamodb client to run migrate() against in-memory tables, keyed by (IP, UA)
+    """
+
+    def __init__(self, **tables):
+        self.tables = {name: {(i["IP"]["S"], i["UA"]["S"]): i for i in items} for name, items in tables.items()}
+        self.delete_fails = 0  # how many of the next delete_item calls raise
+        self.put_item = Mock(side_effect=self._put_item)
+        self.delete_item = Mock(side_effect=self._delete_item)
+
+    def get_paginator(self, op):
+        tables = self.tables
+        paginator = Mock()
+        paginator.paginate.side_effect = lambda TableName, **kwargs: [{"Items": [
+            dict(i) for i in tables[TableName].values() if i.get("test", {}).get("BOOL")]}]
+        return paginator
+
+    def _put_item(self, TableName, Item):
+        self.tables[TableName][(Item["IP"]["S"], Item["UA"]["S"])] = dict(Item)
+
+    def _delete_item(self, TableName, Key):
+        if self.delete_fails:
+            self.delete_fails -= 1
+            raise client_error("ProvisionedThroughputExceededException")
+        del self.tables[TableName][(Key["IP"]["S"], Key["UA"]["S"])]
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError({"Error": {"Code": code}}, "dummyop")
+
+
+class TestTtlBackfill:
+    legacy = {"IP": {"S": "10.0.0.1"}, "UA": {"S": "legacyUA"}}
+    refreshed_legacy = {"IP": {"S": "10.0.0.2"}, "UA": {"S": "legacyUA"}, "expires": {"N": "9"}}
+    added_by_function = {"IP": {"S": "10.0.0.3"}, "UA": {"S": "newUA"}, "expires": {"N": "9"}, "since": {"N": "1"}}
+    test = {"IP": {"S": "10.0.0.4"}, "UA": {"S": "testUA"}, "test": {"BOOL": True}}
+
+    def visitor_updates(self, client):
+        return [c.kwargs for c in client.update_item.call_args_list if c.kwargs["TableName"] == FetchUpdate.TBL_NAME]
+
+    def seed_update(self, client):
+        return [c.kwargs for c in client.update_item.call_args_list
+                if c.kwargs["TableName"] == FetchUpdate.STATS_TBL_NAME][0]
+
+    def test_unstamped_items_stamped(self):
+        # Arrange
+        client = Mock()
+        client.get_paginator.return_value = paginator_over([self.legacy, self.refreshed_legacy], [self.test])
+
+        # Act
+        stamped, seeded = backfill(client, now=1000)
+
+        # Assert
+        assert stamped == 2
+        updates = self.visitor_updates(client)
+        assert [u["Key"] for u in updates] == [{"IP": self.legacy["IP"], "UA": self.legacy["UA"]},
+                                               {"IP": self.test["IP"], "UA": self.test["UA"]}]
+        assert all(u["ExpressionAttributeValues"] == {":exp": {"N": str(1000 + FetchUpdate.VISITOR_TTL_SEC)}}
+                   for u in updates)
+        assert all(u["ConditionExpression"] == "attribute_not_exists(expires)" for u in updates)
+
+    def test_stamped_items_skipped(self):
+        client = Mock()
+        client.get_paginator.return_value = paginator_over([self.refreshed_legacy, self.added_by_function])
+
+        stamped, seeded = backfill(client)
+
+        assert stamped == 0
+        assert self.visitor_updates(client) == []
+
+    def test_refreshed_meanwhile_tolerated(self):
+        client = Mock()
+        client.get_paginator.return_value = paginator_over([self.legacy])
+        client.update_item.side_effect = [client_error("ConditionalCheckFailedException"), {}]
+
+        stamped, seeded = backfill(client)
+
+        assert stamped == 0
+        assert seeded == 1
+
+    def test_other_error_raised(self):
+        client = Mock()
+        client.get_paginator.return_value = paginator_over([self.legacy])
+        client.update_item.side_effect = client_error("StillAClientError")
+
+        with pytest.raises(botocore.exceptions.ClientError):
+            backfill(client)
+
+    def test_seed_leaves_out_test_and_already_counted_items(self):
+        """
+        Only real visitors without `since` were never counted by the function
+        """
+        # Arrange
+        client = Mock()
+        client.get_paginator.return_value = paginator_over(
+            [self.legacy, self.refreshed_legacy, self.added_by_function, self.test])
+
+        # Act
+        stamped, seeded = backfill(client, now=1000)
+
+        # Assert
+        assert seeded == 2
+        seed = self.seed_update(client)
+        assert seed["Key"] == {"Stat": {"S": FetchUpdate.STAT_LIFETIME}}
+        assert seed["UpdateExpression"] == "ADD Visitors :n SET Seeded = :t"
+        assert seed["ConditionExpression"] == "attribute_not_exists(Seeded)"
+        assert seed["ExpressionAttributeValues"][":n"] == {"N": "2"}
+
+    def test_already_seeded_skipped_and_logged(self, caplog):
+        """
+        Seeding twice would double count, so a seeded aggregate is left untouched, but not silently
+        """
+        client = Mock()
+        client.get_paginator.return_value = paginator_over([self.legacy])
+        client.update_item.side_effect = [{}, client_error("ConditionalCheckFailedException")]
+
+        stamped, seeded = backfill(client)
+
+        assert stamped == 1
+        assert seeded is None
+        assert "already seeded" in caplog.text
+
+
+class TestIsolateTestItems:
+    def test_test_items_moved(self):
+        # Arrange
+        stamped = {"IP": {"S": "10.0.0.1"}, "UA": {"S": "testUA1"}, "test": {"BOOL": True}, "expires": {"N": "5"}}
+        unstamped = {"IP": {"S": "10.0.0.2"}, "UA": {"S": "testUA2"}, "test": {"BOOL": True}}
+        client = Mock()
+        client.get_paginator.return_value = paginator_over([stamped], [unstamped])
+
+        # Act
+        moved = migrate(client, now=1000)
+
+        # Assert
+        assert moved == 2
+        assert client.put_item.call_count == 2
+        assert client.delete_item.call_count == 2
+        first, second = (c.kwargs for c in client.put_item.call_args_list)
+        assert first == {"TableName": FetchUpdate.TEST_TBL_NAME,
+                         "Item": {"IP": {"S": "10.0.0.1"}, "UA": {"S": "testUA1"}, "expires": {"N": "5"}}}
+        assert second["Item"]["expires"] == {"N": str(1000 + FetchUpdate.VISITOR_TTL_SEC)}
+        assert "test" not in second["Item"]
+        client.delete_item.assert_called_with(TableName=FetchUpdate.TBL_NAME,
+                                              Key={"IP": {"S": "10.0.0.2"}, "UA": {"S": "testUA2"}})
+
+    def test_only_test_items_scanned(self):
+        client = Mock()
+        client.get_paginator.return_value = paginator_over([])
+
+        moved = migrate(client)
+
+        assert moved == 0
+        kwargs = client.get_paginator.return_value.paginate.call_args.kwargs
+        assert kwargs["TableName"] == FetchUpdate.TBL_NAME
+        assert kwargs["FilterExpression"] == "test = :istest"
+        client.put_item.assert_not_called()
+        client.delete_item.assert_not_called()
+
+    def test_interrupted_move_loses_nothing_and_rerun_overwrites_copy(self):
+        """
+        delete_item fails after put_item succeeded: the source item must survive,
+        and running again must just overwrite the copy and finish the move
+        """
+        # Arrange
+        flagged = {"IP": {"S": "10.0.0.1"}, "UA": {"S": "testUA1"}, "test": {"BOOL": True}, "expires": {"N": "5"}}
+        real = {"IP": {"S": "10.0.0.9"}, "UA": {"S": "realUA"}, "expires": {"N": "5"}}
+        client = FakeDynamoDB(**{FetchUpdate.TBL_NAME: [flagged, real], FetchUpdate.TEST_TBL_NAME: []})
+        client.delete_fails = 1
+
+        # Act
+        with pytest.raises(botocore.exceptions.ClientError):
+            migrate(client)
+
+        # Assert
+        source, target = client.tables[FetchUpdate.TBL_NAME], client.tables[FetchUpdate.TEST_TBL_NAME]
+        assert ("10.0.0.1", "testUA1") in source
+        assert list(target) == [("10.0.0.1", "testUA1")]
+
+        # Act again
+        moved = migrate(client)
+
+        # Assert
+        assert moved == 1
+        assert list(source) == [("10.0.0.9", "realUA")]
+        assert target == {("10.0.0.1", "testUA1"): {"IP": {"S": "10.0.0.1"}, "UA": {"S": "testUA1"}, "expires": {"N": "5"}}}
+        assert client.put_item.call_count == 2  # the same copy, written twice